@@ -8,35 +8,173 @@ and replay call history for decorated methods.
 import redis
 import uuid
 import functools
-from typing import Union, Callable, Optional
+import msgpack
+import os
+import random
+import threading
+from contextlib import contextmanager
+from redis.utils import HIREDIS_AVAILABLE
+from typing import (Iterable, Iterator, List, Tuple, Union, Callable,
+                    Optional)
+
+if not HIREDIS_AVAILABLE:
+    # Without it redis-py silently falls back to its pure-Python parser
+    raise ImportError("hiredis is required: pip install hiredis")
+
+
+_local = threading.local()
+
+# Call counters are spread over this many sub-keys so concurrent writers
+# do not all serialize on one hot key; readers sum the shards
+COUNTER_SHARDS = 64
+
+# Call history lists keep only this many most recent entries, which bounds
+# their memory and the cost of replay's LRANGEs
+HISTORY_MAX = 10000
+
+
+def _shard_key(name: str) -> str:
+    """
+    Return a randomly chosen shard key of the counter `name`.
+    """
+    return f"{name}:{random.randrange(COUNTER_SHARDS)}"
+
+
+def _shard_keys(name: str) -> List[str]:
+    """
+    Return every shard key of the counter `name`, for a single MGET.
+    """
+    return [f"{name}:{i}" for i in range(COUNTER_SHARDS)]
+
+
+def _sum_shards(shards: List[Optional[bytes]]) -> int:
+    """
+    Total the MGET reply for a counter's shard keys.
+    """
+    return sum(int(v) for v in shards if v is not None)
+
+
+def _pack(value) -> bytes:
+    """
+    Serialize a call-history entry with msgpack; unsupported types fall
+    back to their str() form.
+    """
+    return msgpack.packb(value, use_bin_type=True, default=str)
+
+
+def _unpack(data: bytes):
+    """
+    Decode a call-history entry produced by `_pack`.
+    """
+    return msgpack.unpackb(data, raw=False)
+
+
+_clients: Optional[Tuple[redis.Redis, redis.Redis]] = None
+
+
+def _get_clients() -> Tuple[redis.Redis, redis.Redis]:
+    """
+    Return the process-wide (bytes, decoding) client pair, creating it on
+    first use so every Cache instance shares the same connection pools.
+    They connect over REDIS_UNIX_SOCKET when it is set and non-empty
+    (as in web_common.transport), else over TCP.
+    """
+    global _clients
+    if _clients is None:
+        path = os.environ.get("REDIS_UNIX_SOCKET") or None
+        _clients = (redis.Redis(unix_socket_path=path),
+                    redis.Redis(unix_socket_path=path, decode_responses=True))
+    return _clients
+
+
+@contextmanager
+def _batched(client: redis.Redis) -> Iterator[redis.client.Pipeline]:
+    """
+    Yield a non-transactional pipeline on which Redis commands are queued.
+    Nested blocks on the same client share the outermost pipeline, which is
+    executed in a single round-trip when that outermost block exits.
+    It is executed even if the block raises, so commands queued before the
+    error still run, as they would have unbatched: a decorated method that
+    raises is still counted and its inputs still logged.
+    """
+    pipe = getattr(_local, "pipe", None)
+    if pipe is not None and getattr(_local, "client", None) is client:
+        yield pipe
+        return
+
+    pipe = client.pipeline(transaction=False)
+    _local.pipe, _local.client = pipe, client
+    try:
+        yield pipe
+    finally:
+        _local.pipe = _local.client = None
+        try:
+            pipe.execute()
+        finally:
+            pipe.reset()
 
 
 def count_calls(method: Callable) -> Callable:
     """
     Decorator that counts how many times a method is called.
-    Uses Redis to persist the count, keyed by the method's qualified name.
+    Uses Redis to persist the count, sharded under the method's qualified
+    name (see `_shard_keys`).
+    The INCR is queued on the current batch pipeline (see `_batched`).
     """
+    name = method.__qualname__
+
     @functools.wraps(method)
     def wrapper(self, *args, **kwargs):
-        self._redis.incr(method.__qualname__)
-        return method(self, *args, **kwargs)
+        with _batched(self._redis) as pipe:
+            pipe.incr(_shard_key(name))
+            return method(self, *args, **kwargs)
     return wrapper
 
 
 def call_history(method: Callable) -> Callable:
     """
     Decorator that stores the history of inputs and outputs for a function.
-    Saves to Redis lists using keys <method_name>:inputs and <method_name>:outputs.
+    Saves to Redis lists using keys <method_name>:inputs and <method_name>:outputs,
+    each capped at the HISTORY_MAX most recent entries.
+    Both RPUSHes are queued on the current batch pipeline (see `_batched`).
+    Inputs are msgpack-encoded (see `_pack`); outputs are pushed as-is, so
+    the method must return a value Redis accepts (str, bytes, int, float).
     """
+    input_key = method.__qualname__ + ":inputs"
+    output_key = method.__qualname__ + ":outputs"
+
     @functools.wraps(method)
     def wrapper(self, *args, **kwargs):
-        input_key = method.__qualname__ + ":inputs"
-        output_key = method.__qualname__ + ":outputs"
+        with _batched(self._redis) as pipe:
+            pipe.rpush(input_key, _pack(args))
+            pipe.ltrim(input_key, -HISTORY_MAX, -1)
+            result = method(self, *args, **kwargs)
+            pipe.rpush(output_key, result)
+            pipe.ltrim(output_key, -HISTORY_MAX, -1)
+            return result
+    return wrapper
+
+
+def instrumented(method: Callable) -> Callable:
+    """
+    Decorator equivalent to stacking call_history over count_calls, fused
+    into one wrapper so each call pays a single extra Python frame.
+    Key names are computed once, when the decorator is applied.
+    """
+    name = method.__qualname__
+    input_key = name + ":inputs"
+    output_key = name + ":outputs"
 
-        self._redis.rpush(input_key, str(args))
-        result = method(self, *args, **kwargs)
-        self._redis.rpush(output_key, str(result))
-        return result
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with _batched(self._redis) as pipe:
+            pipe.rpush(input_key, _pack(args))
+            pipe.ltrim(input_key, -HISTORY_MAX, -1)
+            pipe.incr(_shard_key(name))
+            result = method(self, *args, **kwargs)
+            pipe.rpush(output_key, result)
+            pipe.ltrim(output_key, -HISTORY_MAX, -1)
+            return result
     return wrapper
 
 
@@ -46,38 +184,75 @@ class Cache:
     Supports storing, retrieving, counting calls, and logging I/O history.
     """
 
-    def __init__(self) -> None:
+    def __init__(self, flush: bool = False) -> None:
         """
-        Initialize the Redis client and flush the current database.
+        Attach to the shared Redis clients (see `_get_clients`).
+        `_text` decodes replies to str in the protocol parser, for get_str.
+
+        Args:
+            flush (bool): Whether to flush the current database first.
         """
-        self._redis = redis.Redis()
-        self._redis.flushdb()
+        self._redis, self._text = _get_clients()
+        if flush:
+            self._redis.flushdb()
 
-    @call_history
-    @count_calls
-    def store(self, data: Union[str, bytes, int, float]) -> str:
+    @instrumented
+    def store(self, data: Union[str, bytes, int, float]) -> bytes:
         """
         Generate a random key, store the given data in Redis, and return the key.
+        The SET shares one pipeline with the decorator's INCR and RPUSHes,
+        so the whole call costs a single round-trip.
 
         Args:
             data (Union[str, bytes, int, float]): The data to store.
 
         Returns:
-            str: The key under which the data was stored.
+            bytes: The key under which the data was stored, as the 16 raw
+            bytes of a UUID4 (less than half the size of its hex form).
         """
-        key = str(uuid.uuid4())
-        self._redis.set(key, data)
+        key = uuid.uuid4().bytes
+        with _batched(self._redis) as pipe:
+            pipe.set(key, data)
         return key
 
+    def store_many(self,
+                   datas: Iterable[Union[str, bytes, int, float]]
+                   ) -> List[bytes]:
+        """
+        Store every item of datas under its own random key in one round-trip.
+        Recorded exactly as if store() had been called once per item: a
+        single MSET, one variadic RPUSH per history list and one INCRBY.
+
+        Args:
+            datas (Iterable[Union[str, bytes, int, float]]): The data to store.
+
+        Returns:
+            List[bytes]: The keys, in the same order as datas.
+        """
+        datas = list(datas)
+        if not datas:
+            return []
+
+        name = self.store.__qualname__
+        keys = [uuid.uuid4().bytes for _ in datas]
+        with _batched(self._redis) as pipe:
+            pipe.incrby(_shard_key(name), len(datas))
+            pipe.rpush(f"{name}:inputs", *(_pack((d,)) for d in datas))
+            pipe.ltrim(f"{name}:inputs", -HISTORY_MAX, -1)
+            pipe.mset(dict(zip(keys, datas)))
+            pipe.rpush(f"{name}:outputs", *keys)
+            pipe.ltrim(f"{name}:outputs", -HISTORY_MAX, -1)
+        return keys
+
     def get(self,
-            key: str,
+            key: Union[str, bytes],
             fn: Optional[Callable] = None
             ) -> Union[bytes, str, int, float, None]:
         """
         Retrieve the value from Redis using the given key and convert it using fn.
 
         Args:
-            key (str): The Redis key.
+            key (Union[str, bytes]): The Redis key.
             fn (Callable, optional): A function to convert the result.
 
         Returns:
@@ -88,29 +263,30 @@ class Cache:
             return None
         return fn(value) if fn else value
 
-    def get_str(self, key: str) -> Optional[str]:
+    def get_str(self, key: Union[str, bytes]) -> Optional[str]:
         """
         Retrieve the value from Redis and decode it from bytes to UTF-8 string.
 
         Args:
-            key (str): The Redis key.
+            key (Union[str, bytes]): The Redis key.
 
         Returns:
             Optional[str]: The decoded string, or None if the key doesn't exist.
         """
-        return self.get(key, fn=lambda d: d.decode("utf-8"))
+        return self._text.get(key)
 
-    def get_int(self, key: str) -> Optional[int]:
+    def get_int(self, key: Union[str, bytes]) -> Optional[int]:
         """
         Retrieve the value from Redis and convert it to an integer.
 
         Args:
-            key (str): The Redis key.
+            key (Union[str, bytes]): The Redis key.
 
         Returns:
             Optional[int]: The integer value, or None if the key doesn't exist.
         """
-        return self.get(key, fn=int)
+        value = self._redis.get(key)
+        return None if value is None else int(value)
 
 
 def replay(method: Callable) -> None:
@@ -125,14 +301,18 @@ def replay(method: Callable) -> None:
     """
     r = method.__self__._redis
     method_name = method.__qualname__
-    count = r.get(method_name).decode('utf-8') if r.get(method_name) else 0
 
-    print(f"{method_name} was called {count} times:")
+    # Fetch the count and both history lists in a single round-trip
+    pipe = r.pipeline(transaction=False)
+    pipe.mget(_shard_keys(method_name))
+    pipe.lrange(f"{method_name}:inputs", 0, -1)
+    pipe.lrange(f"{method_name}:outputs", 0, -1)
+    shards, inputs, outputs = pipe.execute()
 
-    inputs = r.lrange(f"{method_name}:inputs", 0, -1)
-    outputs = r.lrange(f"{method_name}:outputs", 0, -1)
+    print(f"{method_name} was called {_sum_shards(shards)} times:")
 
     for args, output in zip(inputs, outputs):
-        args_str = args.decode('utf-8')
-        output_str = output.decode('utf-8')
-        print(f"{method_name}(*{args_str}) -> {output_str}")
+        args_repr = tuple(_unpack(args))
+        # Outputs are stored raw (e.g. 16-byte UUID keys), so always show
+        # their repr rather than writing arbitrary bytes to the terminal
+        print(f"{method_name}(*{args_repr}) -> {output!r}")
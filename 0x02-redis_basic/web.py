@@ -4,47 +4,351 @@ Module for caching HTML page content using Redis and tracking
 access count for each URL with an expiration policy.
 """
 
+import atexit
+import os
 import requests
 import redis
+import threading
+import time
+from cachetools import TLRUCache
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
-from typing import Callable
+from requests.adapters import HTTPAdapter
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib3.util.retry import Retry
+from web_common import (CACHE_PREFIX, CHUNK_SIZE, COUNTS_KEY, LOCK_PREFIX,
+                        MAX_PAGE_BYTES, decode_page, encode_page, page_key,
+                        transport)
 
 
-# Create Redis client
-r = redis.Redis()
+# Shared, bounded connection pool so every call reuses a pooled socket.
+# Callers wait up to `timeout` for a free connection instead of failing
+# once all are busy; connection options such as client_name have to be
+# set here, since redis-py ignores them on a client given a pool. The
+# transport (TCP or REDIS_UNIX_SOCKET) comes from web_common.
+_pool = redis.BlockingConnectionPool(
+    max_connections=32, timeout=5, socket_timeout=2.0,
+    health_check_interval=30, client_name="web_cache",
+    **transport(redis.UnixDomainSocketConnection))
+_redis = redis.Redis(connection_pool=_pool)
 
+# Access counts are buffered in-process and written to Redis in one
+# pipeline, so counting adds no round-trip to a request. There is no
+# timer: the access that finds FLUSH_EVERY accesses buffered, or
+# FLUSH_INTERVAL seconds passed since the last flush, flushes them, and
+# interpreter exit flushes the rest. An idle process keeps its counts
+# until its next access or exit, and loses them if killed. Counts in
+# Redis are therefore eventually consistent; see flush_counts.
+FLUSH_EVERY = 100
+FLUSH_INTERVAL = 1.0
+_pending: Counter = Counter()
+_pending_hits = 0
+_last_flush = time.monotonic()
+_pending_lock = threading.Lock()
 
-def count_and_cache(fn: Callable[[str], str]) -> Callable[[str], str]:
+# In-process tier in front of Redis: url -> (monotonic deadline, page).
+# Entries expire together with their Redis copy, so a page is never
+# served for longer than it would have been from Redis alone.
+_pages = TLRUCache(maxsize=1024, ttu=lambda _url, entry, _now: entry[0])
+_pages_lock = threading.Lock()
+
+# Only one caller per URL fetches a missing page; the others poll Redis
+# for its result. The lock is released only by the holder of its random
+# token, and its TTL exceeds get_page's worst case (see FETCH_DEADLINE)
+# so it cannot lapse mid-fetch.
+LOCK_TTL_MS = 30000
+LOCK_POLLS = 10
+LOCK_POLL_INTERVAL = 0.05
+_release_lock = _redis.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+# (connect, read) timeouts for page fetches, in seconds. These bound
+# each socket operation, not the whole fetch, so get_page also gives up
+# once FETCH_DEADLINE seconds have passed since it started. Up to three
+# attempts (see Retry below) can spend about 3 * sum(TIMEOUT) + backoff,
+# roughly 25 s, before a response arrives; after that no new body read
+# starts once the deadline has passed, so a fetch ends inside
+# LOCK_TTL_MS.
+TIMEOUT = (3.05, 5.0)
+FETCH_DEADLINE = 15.0
+
+# Shared HTTP session so cache misses reuse keep-alive connections;
+# pool_connections is the number of hosts kept, pool_maxsize the
+# sockets kept per host
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32,
+                       max_retries=Retry(total=2, backoff_factor=0.1))
+_session.mount("http://", _adapter)
+_session.mount("https://", _adapter)
+
+
+def _count(url: str) -> None:
+    """
+    Buffer one access of `url`, flushing the buffer when it is due.
+    Counts are a soft metric, so a failed flush never fails the request;
+    its counts stay buffered for the next one.
+    """
+    global _pending_hits
+    with _pending_lock:
+        _pending[url] += 1
+        _pending_hits += 1
+        due = (_pending_hits >= FLUSH_EVERY
+               or time.monotonic() - _last_flush >= FLUSH_INTERVAL)
+    if due:
+        try:
+            flush_counts()
+        except redis.RedisError:
+            pass
+
+
+def flush_counts() -> None:
+    """
+    Write the buffered access counts to Redis in a single pipeline.
+    If Redis is unreachable the counts are put back in the buffer for
+    the next flush and the RedisError is raised.
+    """
+    global _pending, _pending_hits, _last_flush
+    with _pending_lock:
+        counts, _pending = _pending, Counter()
+        _pending_hits = 0
+        _last_flush = time.monotonic()
+    if not counts:
+        return
+
+    pipe = _redis.pipeline(transaction=False)
+    for url, n in counts.items():
+        pipe.hincrby(COUNTS_KEY, url, n)
+    try:
+        pipe.execute()
+    except redis.RedisError:
+        with _pending_lock:
+            _pending.update(counts)
+            _pending_hits += sum(counts.values())
+        raise
+
+
+def _flush_at_exit() -> None:
+    """
+    Flush the remaining counts at interpreter exit. There is no later
+    flush to retry, so if Redis is unreachable they are dropped.
+    """
+    try:
+        flush_counts()
+    except redis.RedisError:
+        pass
+
+
+atexit.register(_flush_at_exit)
+
+
+def _remember(url: str, page: bytes, ttl: float) -> None:
+    """
+    Keep `page` in the in-process tier for the next `ttl` seconds.
+    """
+    if ttl > 0:
+        with _pages_lock:
+            _pages[url] = (time.monotonic() + ttl, page)
+
+
+def _peek(cache_key: bytes) -> Tuple[Optional[bytes], float]:
+    """
+    Return the cached page (or None) and its remaining TTL in seconds.
+    """
+    pipe = _redis.pipeline(transaction=False)
+    pipe.get(cache_key)
+    pipe.pttl(cache_key)
+    data, ttl_ms = pipe.execute()
+    page = decode_page(data) if data is not None else None
+    return page, ttl_ms / 1000
+
+
+def _store(cache_key: bytes, page: bytes) -> None:
+    """
+    Cache `page` for 10 seconds unless a concurrent miss already has;
+    the first writer wins.
+    """
+    _redis.set(cache_key, encode_page(page), ex=10, nx=True)
+
+
+def _fetch_once(url: str, cache_key: bytes,
+                fn: Callable[[str], bytes]) -> Tuple[bytes, float]:
+    """
+    Fetch and cache a missing page, letting only one concurrent caller
+    per URL run `fn`. Returns the page and its remaining TTL in seconds.
+    """
+    lock_key = page_key(LOCK_PREFIX, url)
+    token = os.urandom(16)
+    if _redis.set(lock_key, token, nx=True, px=LOCK_TTL_MS):
+        try:
+            # Another caller may have filled the cache before we locked
+            page, ttl = _peek(cache_key)
+            if page:
+                return page, ttl
+            page = fn(url)
+            _store(cache_key, page)
+            return page, 10
+        finally:
+            _release_lock(keys=[lock_key], args=[token])
+
+    for _ in range(LOCK_POLLS):
+        time.sleep(LOCK_POLL_INTERVAL)
+        page, ttl = _peek(cache_key)
+        if page:
+            return page, ttl
+
+    # The lock holder is slow or gone: fetch without waiting any longer
+    page = fn(url)
+    _store(cache_key, page)
+    return page, 10
+
+
+def count_and_cache(fn: Callable[[str], bytes]) -> Callable[[str], bytes]:
     """
     Decorator that increments the access count for a URL and
     caches the HTML content for 10 seconds.
     """
     @wraps(fn)
-    def wrapper(url: str) -> str:
-        cache_key: str = f"cached:{url}"
-        count_key: str = f"count:{url}"
+    def wrapper(url: str) -> bytes:
+        cache_key: bytes = page_key(CACHE_PREFIX, url)
+        _count(url)
 
-        # Increment number of times the URL is accessed
-        r.incr(count_key)
+        with _pages_lock:
+            entry = _pages.get(url)
+        if entry is not None:
+            return entry[1]
 
-        # Try to get cached response
-        cached: bytes = r.get(cache_key)
+        # Look up the cached response and its remaining TTL
+        cached, ttl = _peek(cache_key)
         if cached:
-            return cached.decode("utf-8")
+            _remember(url, cached, ttl)
+            return cached
 
-        # Not cached: make request and cache it
-        result: str = fn(url)
-        r.setex(cache_key, 10, result)
+        # Not cached: make request (once across concurrent callers) and
+        # cache it, unless a concurrent miss already has; the first
+        # writer wins
+        result, ttl = _fetch_once(url, cache_key, fn)
+        _remember(url, result, ttl)
         return result
 
     return wrapper
 
 
+def get_count(url: str) -> int:
+    """
+    Return how many times `url` has been requested, counting both Redis
+    and the accesses this process has not flushed yet.
+    """
+    count = _redis.hget(COUNTS_KEY, url)
+    with _pending_lock:
+        pending = _pending[url]
+    return pending + int(count or 0)
+
+
+def _fetch_page(url: str) -> bytes:
+    """
+    Fetch the raw body of `url`, bypassing both cache tiers and the
+    access count; get_page and get_pages cache its result.
+    Raises ValueError for bodies over MAX_PAGE_BYTES and requests.Timeout
+    when the fetch runs past FETCH_DEADLINE.
+    """
+    deadline = time.monotonic() + FETCH_DEADLINE
+    with _session.get(url, stream=True, timeout=TIMEOUT) as response:
+        # Only 2xx bodies are cached. This is stricter than
+        # raise_for_status(), which lets 1xx and 3xx responses (e.g. an
+        # unfollowed redirect) through
+        if not 200 <= response.status_code < 300:
+            raise requests.HTTPError(
+                f"{response.status_code} {response.reason} for url: {url}",
+                response=response)
+        body = bytearray()
+        chunks = response.iter_content(CHUNK_SIZE)
+        while time.monotonic() <= deadline:
+            chunk = next(chunks, None)
+            if chunk is None:
+                return bytes(body)
+            body += chunk
+            if len(body) > MAX_PAGE_BYTES:
+                raise ValueError(f"{url} exceeds {MAX_PAGE_BYTES} bytes")
+        raise requests.Timeout(f"{url} took longer than {FETCH_DEADLINE} s")
+
+
 @count_and_cache
-def get_page(url: str) -> str:
+def get_page(url: str) -> bytes:
     """
-    Fetches the HTML content of a given URL and caches it
+    Fetches the raw HTML content of a given URL and caches it
     using Redis for 10 seconds, while tracking access count.
+    The body is kept as bytes end to end; see get_page_text.
+    Raises as _fetch_page does on a miss.
+    """
+    return _fetch_page(url)
+
+
+def get_page_text(url: str) -> str:
+    """
+    Return get_page(url) decoded as UTF-8, for callers that need a str.
+    """
+    return get_page(url).decode("utf-8", "replace")
+
+
+def get_pages(urls: List[str]) -> List[bytes]:
+    """
+    Fetch many pages at once, in the same order as urls. Pages not held
+    in-process are read from Redis in one pipeline; the remaining misses
+    are fetched concurrently and cached with one more pipeline.
+    Concurrent misses on the same URL are not single-flighted here.
+
+    The result is all-or-nothing: if any fetch fails, the pages that did
+    arrive are still cached, then the first failure (requests.HTTPError,
+    requests.Timeout, ValueError, ...) is raised.
     """
-    response = requests.get(url)
-    return response.text
+    found: Dict[str, bytes] = {}
+    with _pages_lock:
+        for url in urls:
+            entry = _pages.get(url)
+            if entry is not None:
+                found[url] = entry[1]
+    for url in urls:
+        _count(url)
+
+    lookups = [url for url in dict.fromkeys(urls) if url not in found]
+    if lookups:
+        keys = [page_key(CACHE_PREFIX, url) for url in lookups]
+        pipe = _redis.pipeline(transaction=False)
+        pipe.mget(keys)
+        for key in keys:
+            pipe.pttl(key)
+        cached, *ttls_ms = pipe.execute()
+        for url, data, ttl_ms in zip(lookups, cached, ttls_ms):
+            page = decode_page(data) if data is not None else b""
+            if page:
+                found[url] = page
+                _remember(url, page, ttl_ms / 1000)
+
+    missing = [url for url in lookups if url not in found]
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(16, len(missing))) as pool:
+            futures = {url: pool.submit(_fetch_page, url)
+                       for url in missing}
+
+        errors: List[Exception] = []
+        pipe = _redis.pipeline(transaction=False)
+        for url, future in futures.items():
+            try:
+                page = future.result()
+            except (requests.RequestException, ValueError) as e:
+                errors.append(e)
+                continue
+            found[url] = page
+            pipe.set(page_key(CACHE_PREFIX, url), encode_page(page),
+                     ex=10, nx=True)
+            _remember(url, page, 10)
+        pipe.execute()
+        if errors:
+            raise errors[0]
+
+    return [found[url] for url in urls]
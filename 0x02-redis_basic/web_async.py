@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Asynchronous counterpart of web.py: caches HTML page content in Redis
+and tracks the access count for each URL, using redis.asyncio and
+aiohttp so many lookups can be in flight on one event loop.
+"""
+
+import asyncio
+import aiohttp
+import redis.asyncio as aioredis
+from functools import wraps
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+from web_common import (CACHE_PREFIX, CHUNK_SIZE, COUNTS_KEY, MAX_PAGE_BYTES,
+                        decode_page, encode_page, page_key, transport)
+
+
+# Increment the access count and return the cached page (or nil) in one
+# atomic server-side call; redis-py reuses the script via EVALSHA
+_COUNT_AND_GET = """
+redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+return redis.call('GET', KEYS[2])
+"""
+
+# The Redis pool (its Condition and sockets), the client and script on
+# it, and the aiohttp session are all bound to the event loop that first
+# uses them. They are created lazily on the running loop and rebuilt
+# when another loop, e.g. a later asyncio.run, takes over.
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_pool: Optional[aioredis.BlockingConnectionPool] = None
+_redis: Optional[aioredis.Redis] = None
+_count_and_get: Optional[Callable[..., Awaitable[Any]]] = None
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def _check_loop() -> None:
+    """
+    Forget loop-bound clients created on a different event loop; they
+    cannot be used, or even closed, from the running one.
+    """
+    global _loop, _pool, _redis, _count_and_get, _session
+    loop = asyncio.get_running_loop()
+    if loop is not _loop:
+        _loop = loop
+        _pool = _redis = _count_and_get = _session = None
+
+
+def _get_redis() -> Tuple[aioredis.Redis, Callable[..., Awaitable[Any]]]:
+    """
+    Return the running loop's Redis client and count-and-get script,
+    creating its bounded pool (configured like web.py's, including the
+    REDIS_UNIX_SOCKET transport) on first use.
+    """
+    global _pool, _redis, _count_and_get
+    _check_loop()
+    if _redis is None or _count_and_get is None:
+        _pool = aioredis.BlockingConnectionPool(
+            max_connections=32, timeout=5, socket_timeout=2.0,
+            health_check_interval=30, client_name="web_cache",
+            **transport(aioredis.UnixDomainSocketConnection))
+        _redis = aioredis.Redis(connection_pool=_pool)
+        _count_and_get = _redis.register_script(_COUNT_AND_GET)
+    return _redis, _count_and_get
+
+
+def _get_session() -> aiohttp.ClientSession:
+    """
+    Return the running loop's HTTP session, opening it on first use.
+    Its timeouts match web.TIMEOUT and bound each socket operation only.
+    A `total` timeout would also count the wait for one of the
+    connector's 32 slots, so requests queued behind slow ones in a large
+    get_pages batch would time out without ever being sent.
+    """
+    global _session
+    _check_loop()
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=3.05,
+                                          sock_read=5.0))
+    return _session
+
+
+async def close() -> None:
+    """
+    Close the running loop's HTTP session and Redis connections, and
+    forget them so the next call on any loop builds fresh ones. Call
+    this before the loop is closed to release their sockets cleanly.
+    """
+    global _loop, _pool, _redis, _count_and_get, _session
+    _check_loop()
+    if _session is not None:
+        await _session.close()
+    if _pool is not None:
+        await _pool.disconnect()
+    _loop = None
+    _pool = _redis = _count_and_get = _session = None
+
+
+def count_and_cache(
+        fn: Callable[[str], Awaitable[bytes]]
+        ) -> Callable[[str], Awaitable[bytes]]:
+    """
+    Decorator that increments the access count for a URL and
+    caches the HTML content for 10 seconds.
+    """
+    @wraps(fn)
+    async def wrapper(url: str) -> bytes:
+        cache_key: bytes = page_key(CACHE_PREFIX, url)
+        client, count_and_get = _get_redis()
+
+        # Increment the access count and look up the cached response
+        cached = await count_and_get(keys=[COUNTS_KEY, cache_key],
+                                     args=[url])
+        page = decode_page(cached) if cached else None
+        if page is not None:
+            return page
+
+        # Not cached: make request and cache it, unless a concurrent
+        # miss already has; the first writer wins
+        result: bytes = await fn(url)
+        await client.set(cache_key, encode_page(result), ex=10, nx=True)
+        return result
+
+    return wrapper
+
+
+@count_and_cache
+async def get_page(url: str) -> bytes:
+    """
+    Fetches the raw HTML content of a given URL without blocking the
+    event loop and caches it using Redis for 10 seconds. The body stays
+    bytes, as in web.get_page; decode it where a str is needed.
+    Raises ValueError for bodies over MAX_PAGE_BYTES.
+    """
+    async with _get_session().get(url) as response:
+        response.raise_for_status()
+        body = bytearray()
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            body += chunk
+            if len(body) > MAX_PAGE_BYTES:
+                raise ValueError(f"{url} exceeds {MAX_PAGE_BYTES} bytes")
+        return bytes(body)
+
+
+async def get_pages(urls: List[str]) -> List[bytes]:
+    """
+    Fetch many pages concurrently, in the same order as urls; their
+    Redis lookups and HTTP requests overlap on the event loop.
+    """
+    return list(await asyncio.gather(*(get_page(url) for url in urls)))
+
+
+def get_page_sync(url: str) -> bytes:
+    """
+    Blocking shim around get_page for callers without an event loop.
+    Each call runs on a fresh loop, so its connections are closed (see
+    close()) before asyncio.run closes that loop.
+    """
+    async def run() -> bytes:
+        try:
+            return await get_page(url)
+        finally:
+            await close()
+
+    return asyncio.run(run())
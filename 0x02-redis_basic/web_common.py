@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Key layout, page framing and Redis transport settings shared by web.py
+and web_async.py, so both read and write the same cache entries.
+Importing this module only reads the environment and checks that
+hiredis is installed; it opens no connections.
+"""
+
+import hashlib
+import os
+import threading
+import zstandard
+from redis.utils import HIREDIS_AVAILABLE
+from typing import Any, Dict, Optional, Type
+
+if not HIREDIS_AVAILABLE:
+    # Cached pages are large GET replies; without hiredis redis-py would
+    # silently parse them with its pure-Python parser
+    raise ImportError("hiredis is required: pip install hiredis")
+
+
+# All access counters live in one hash, one field per URL, rather than
+# one top-level key each; HGETALL on it dumps every count
+COUNTS_KEY = "url:counts"
+
+# Prefixes of the per-URL keys built by `page_key`
+CACHE_PREFIX = b"cached:"
+LOCK_PREFIX = b"lock:"
+
+# Bodies are streamed and abandoned past this size, so one huge page can
+# neither exhaust memory nor become an oversized Redis value
+MAX_PAGE_BYTES = 2 << 20
+CHUNK_SIZE = 65536
+
+# Reach a colocated Redis over its unix socket when REDIS_UNIX_SOCKET
+# names one (redis.conf needs `unixsocket` and `unixsocketperm`),
+# skipping the TCP/IP stack; otherwise connect over TCP
+UNIX_SOCKET = os.environ.get("REDIS_UNIX_SOCKET")
+
+# Pages are stored in Redis behind a one-byte format tag: zstd-compressed
+# when that makes them smaller, raw otherwise (e.g. an already
+# compressed body). zstandard contexts are not thread-safe, so each
+# thread gets its own.
+_RAW = b"\x00"
+_ZSTD = b"\x01"
+_codecs = threading.local()
+
+
+def transport(unix_connection_class: Type) -> Dict[str, Any]:
+    """
+    Return the connection-pool keyword arguments selecting the Redis
+    transport: `unix_connection_class` on UNIX_SOCKET when it is set,
+    TCP with keepalive on localhost:6379 otherwise.
+    """
+    if UNIX_SOCKET:
+        return {"connection_class": unix_connection_class,
+                "path": UNIX_SOCKET}
+    return {"host": "localhost", "port": 6379, "socket_keepalive": True}
+
+
+def page_key(prefix: bytes, url: str) -> bytes:
+    """
+    Return a fixed-size Redis key for `url`: `prefix` plus the URL's
+    16-byte BLAKE2b digest, however long the URL itself is.
+    """
+    return prefix + hashlib.blake2b(url.encode(), digest_size=16).digest()
+
+
+def encode_page(page: bytes) -> bytes:
+    """
+    Frame `page` for storage in Redis, compressing it when that pays off.
+    """
+    cctx = getattr(_codecs, "cctx", None)
+    if cctx is None:
+        cctx = _codecs.cctx = zstandard.ZstdCompressor(level=3)
+    packed = cctx.compress(page)
+    if len(packed) < len(page):
+        return _ZSTD + packed
+    return _RAW + page
+
+
+def decode_page(data: bytes) -> Optional[bytes]:
+    """
+    Recover the page framed by `encode_page`. Returns None for an unknown
+    tag (a newer format, or an unframed legacy value), which callers
+    treat as a cache miss.
+    """
+    tag = data[:1]
+    if tag == _RAW:
+        return data[1:]
+    if tag != _ZSTD:
+        return None
+    dctx = getattr(_codecs, "dctx", None)
+    if dctx is None:
+        dctx = _codecs.dctx = zstandard.ZstdDecompressor()
+    return dctx.decompress(data[1:])